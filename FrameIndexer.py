@@ -0,0 +1,234 @@
+import os
+import struct
+import bisect
+import logging
+import tempfile
+from pathlib import Path
+from omegaconf import OmegaConf
+
+from data import read_frame_stats, write_frame_index, read_frame_index_version, FrameIndexEntry
+
+
+logger = logging.getLogger(__name__)
+
+class FrameIndexer:
+	"""
+	Makes an index of the frames in each capture's MP4 file, so the player can step exactly one frame at a time,
+	seek to keyframes and line up the motion graphs with the video. See `FrameIndexEntry` for what is in it.
+	"""
+
+	def __init__(self, config: OmegaConf):
+		self.video_dir = config.video_dir
+		self.data_dir = config.data_dir
+		self.staging_dir = config.staging_dir
+
+
+	def get_frame_index(self, name) -> Path:
+		"""
+		Path of the index for the named capture, making it first if needed.
+		It can't be made until the video has been converted and its motion data saved, in which case the path won't exist.
+		"""
+		index_path = self.data_dir.joinpath(f'{name}.idx')
+		version = read_frame_index_version(index_path)
+		if version == FrameIndexEntry.VERSION:
+			return index_path
+		if version is not None:
+			logger.info(f'Frame index {index_path} is version {version}, so making it again')
+		video_path = self.video_dir.joinpath(f'{name}.mp4')
+		if not video_path.exists() or self.staging_dir.joinpath(f'{name}.h264').exists():
+			logger.info(f'Video for {name} is not ready for indexing')
+			return index_path
+
+		bin_path = self.data_dir.joinpath(f'{name}.bin')
+		if not bin_path.exists():
+			logger.info(f'Motion data for {name} is not ready for indexing')
+			return index_path
+
+		logger.info(f'Creating frame index {index_path}')
+		# Written to a temporary file first, so that another request doesn't find and send a partly written index
+		fd, temp_name = tempfile.mkstemp(prefix=f'{name}.', suffix='.idx.tmp', dir=self.data_dir)
+		os.close(fd)
+		temp_path = Path(temp_name)
+		try:
+			frames = read_mp4_frames(video_path)
+			stats = read_frame_stats(bin_path)
+			entries = align_frame_stats(frames, [each.timestamp for each in stats])
+			write_frame_index(temp_path, entries, len(stats))
+			os.replace(temp_path, index_path)
+		except (OSError, ValueError, struct.error) as e:
+			logger.error(f'Could not create frame index for {video_path}. {e}')
+		finally:
+			temp_path.unlink(missing_ok=True)
+		return index_path
+
+
+def align_frame_stats(frames, stats_timestamps) -> list[FrameIndexEntry]:
+	"""
+	Match each frame to the FrameStats nearest in time.
+	The recorder stops collecting stats just after writing the last of the video, so both end at about the same
+	time, whereas the start of the video is wherever the circular buffer's first keyframe happened to be.
+	So the video is lined up with the stats by its last frame.
+	"""
+	entries = []
+	last_pts = max((each[0] for each in frames), default=0)
+	for pts, offset, size, keyframe in frames:
+		stats_index = -1
+		if stats_timestamps:
+			t = stats_timestamps[-1] - (last_pts - pts)
+			i = bisect.bisect_left(stats_timestamps, t)
+			if i == len(stats_timestamps) or i > 0 and t - stats_timestamps[i - 1] < stats_timestamps[i] - t:
+				i -= 1
+			stats_index = i
+		entries.append(FrameIndexEntry(pts, offset, size, stats_index, keyframe))
+	return entries
+
+
+def read_mp4_frames(path: Path):
+	"""
+	Read the sample tables of the first video track in an MP4 file.
+	Returns a list of (presentation time in microseconds, byte offset, size, is keyframe), in presentation order.
+	"""
+	moov = None
+	with open(path, 'rb') as f:
+		for box_type, start, end in iter_boxes(f, 0, path.stat().st_size):
+			if box_type == b'moov':
+				f.seek(start)
+				moov = f.read(end - start)
+				break
+	if moov is None:
+		raise ValueError('No moov box')
+
+	for box_type, start, end in iter_boxes(moov, 0, len(moov)):
+		if box_type != b'trak':
+			continue
+		trak = children(moov, start, end)
+		mdia = children(moov, *trak[b'mdia'])
+		hdlr_start, _ = mdia[b'hdlr']
+		if moov[hdlr_start + 8:hdlr_start + 12] != b'vide':
+			continue
+		media_time = read_edit_offset(moov, *trak[b'edts']) if b'edts' in trak else 0
+		return read_sample_table(moov, mdia, media_time)
+	raise ValueError('No video track')
+
+
+def iter_boxes(data, start, end):
+	"""Yield (type, content start, content end) of each box between start and end of `data` (bytes or a file)"""
+	pos = start
+	while pos + 8 <= end:
+		if isinstance(data, bytes):
+			header = data[pos:pos + 16]
+		else:
+			data.seek(pos)
+			header = data.read(16)
+		size, box_type = struct.unpack('>I4s', header[:8])
+		header_size = 8
+		if size == 1:
+			size = struct.unpack('>Q', header[8:16])[0]
+			header_size = 16
+		elif size == 0:
+			size = end - pos
+		if size < header_size:
+			raise ValueError(f'Bad size for {box_type} box')
+		yield box_type, pos + header_size, min(pos + size, end)
+		pos += size
+
+
+def children(data, start, end):
+	return {box_type: (s, e) for box_type, s, e in iter_boxes(data, start, end)}
+
+
+def read_full_box(data, start):
+	"""Version, and the position after the version and flags, of a 'full box'"""
+	return data[start], start + 4
+
+
+def read_edit_offset(data, start, end):
+	"""Media time that the first edit starts at, which is when presentation starts"""
+	elst = children(data, start, end).get(b'elst')
+	if elst is None:
+		return 0
+	version, pos = read_full_box(data, elst[0])
+	count = struct.unpack_from('>I', data, pos)[0]
+	pos += 4
+	for _ in range(count):
+		if version == 1:
+			_, media_time = struct.unpack_from('>Qq', data, pos)
+			pos += 20
+		else:
+			_, media_time = struct.unpack_from('>Ii', data, pos)
+			pos += 12
+		if media_time != -1:   # -1 is an empty edit, i.e. a delay before the video starts
+			return media_time
+	return 0
+
+
+def read_sample_table(data, mdia, media_time):
+	mdhd_version, pos = read_full_box(data, mdia[b'mdhd'][0])
+	timescale = struct.unpack_from('>I', data, pos + (16 if mdhd_version == 1 else 8))[0]
+	minf = children(data, *mdia[b'minf'])
+	stbl = children(data, *minf[b'stbl'])
+
+	# Decode times from sample durations
+	decode_times = []
+	t = 0
+	for count, delta in read_table(data, stbl[b'stts'], '>II'):
+		for _ in range(count):
+			decode_times.append(t)
+			t += delta
+
+	# Composition offsets, for when frames are presented in a different order to decoding
+	composition_offsets = [0] * len(decode_times)
+	if b'ctts' in stbl:
+		ctts_version = data[stbl[b'ctts'][0]]
+		i = 0
+		for count, offset in read_table(data, stbl[b'ctts'], '>Ii' if ctts_version == 1 else '>II'):
+			for _ in range(count):
+				composition_offsets[i] = offset
+				i += 1
+
+	# Sizes
+	_, pos = read_full_box(data, stbl[b'stsz'][0])
+	sample_size, count = struct.unpack_from('>II', data, pos)
+	if sample_size == 0:
+		sizes = list(struct.unpack_from(f'>{count}I', data, pos + 8))
+	else:
+		sizes = [sample_size] * count
+
+	# Byte offsets, from chunk offsets and which samples are in each chunk
+	if b'stco' in stbl:
+		chunk_offsets = [each[0] for each in read_table(data, stbl[b'stco'], '>I')]
+	else:
+		chunk_offsets = [each[0] for each in read_table(data, stbl[b'co64'], '>Q')]
+	sample_to_chunk = read_table(data, stbl[b'stsc'], '>III')
+	offsets = []
+	sample = 0
+	for i, (first_chunk, samples_per_chunk, _) in enumerate(sample_to_chunk):
+		last_chunk = sample_to_chunk[i + 1][0] - 1 if i + 1 < len(sample_to_chunk) else len(chunk_offsets)
+		for chunk in range(first_chunk, last_chunk + 1):
+			offset = chunk_offsets[chunk - 1]
+			for _ in range(samples_per_chunk):
+				offsets.append(offset)
+				offset += sizes[sample]
+				sample += 1
+
+	# Keyframes. If there is no table then every frame is a keyframe.
+	if b'stss' in stbl:
+		keyframes = {each[0] - 1 for each in read_table(data, stbl[b'stss'], '>I')}
+	else:
+		keyframes = set(range(len(sizes)))
+
+	# Frames before the edit list's start aren't shown, they are only there to decode the ones after
+	frames = []
+	for i in range(min(len(decode_times), len(sizes), len(offsets))):
+		presentation_time = decode_times[i] + composition_offsets[i] - media_time
+		if presentation_time >= 0:
+			frames.append((presentation_time * 1000000 // timescale, offsets[i], sizes[i], i in keyframes))
+	frames.sort()
+	return frames
+
+
+def read_table(data, box, entry_format):
+	"""Entries of a sample table box, which is a full box followed by an entry count then the entries"""
+	_, pos = read_full_box(data, box[0])
+	count = struct.unpack_from('>I', data, pos)[0]
+	return list(struct.iter_unpack(entry_format, data[pos + 4:pos + 4 + count * struct.calcsize(entry_format)]))
@@ -12,23 +12,27 @@ from omegaconf import OmegaConf
 
 from MotionVectorReader import MotionVectorReader
 from data import CaptureInfo
+from camera_settings import apply_camera_settings
 
 
 logger = logging.getLogger(__name__)
 
-# These settings must be explicitly set when setting up the camera and cannot be changed after
-CAMERA_SETTINGS_TO_IGNORE = {'width', 'height', 'sensor_mode', 'framerate', 'bitrate'}
-
 
 class MotionRecorder(threading.Thread):
 	"""
 	Record video into a circular memory buffer and extract motion vectors for simple motion detection analysis.
 	Enables writing the video frames to file if motion is detected.
+
+	If `camera` is given then it is shared with another recorder which owns it, and this one records a resized
+	stream from its own splitter port.
 	"""
 
-	def __init__(self, config: OmegaConf):
+	def __init__(self, config: OmegaConf, captures: queue.Queue = None, camera: PiCamera = None):
 		super().__init__()
-		self.camera = None
+		self.name = config.name
+		self.camera = camera
+		self.owns_camera = camera is None
+		self.splitter_port = config.splitter_port
 		self.stream = None
 		self.motion = None
 		self.config = config
@@ -40,7 +44,8 @@ class MotionRecorder(threading.Thread):
 		self.file_pattern = '%Y-%m-%dT%H-%M-%S'  # Date pattern for saved recordings
 		self.label_pattern = '%Y-%m-%d %H:%M'    # Date pattern for annotation text
 		self.output_dir = config.staging_dir
-		self.captures = queue.Queue()
+		self.captures = captures if captures is not None else queue.Queue()
+		self.capturing = False   # Whether a video file is being written
 
 		# With clock_mode='raw' (see `start_camera`), timestamp is microseconds since system boot.
 		# Get boot time here to calculate absolute time of recording.
@@ -51,14 +56,17 @@ class MotionRecorder(threading.Thread):
 
 	def __enter__(self):
 		self.start_camera()
-		threading.Thread(name='annotate', target=self.annotate_with_datetime, args=(self.camera,), daemon=True).start()
-		logger.info('Motion recorder ready')
+		if self.owns_camera:
+			threading.Thread(name='annotate', target=self.annotate_with_datetime, args=(self.camera,), daemon=True).start()
+		logger.info(f'Motion recorder "{self.name}" ready')
 		return self
 
 
 	def __exit__(self, type, value, traceback):
-		if self.camera.recording:
-			self.camera.stop_recording()
+		try:
+			self.camera.stop_recording(splitter_port=self.splitter_port)
+		except PiCameraNotRecording:
+			pass
 
 
 	def wait(self, timeout=0.0):
@@ -67,7 +75,7 @@ class MotionRecorder(threading.Thread):
 		when instance is being shut down.
 		"""
 		try:
-			self.camera.wait_recording(timeout)
+			self.camera.wait_recording(timeout, splitter_port=self.splitter_port)
 		except PiCameraNotRecording:
 			# that's fine, return immediately
 			pass
@@ -77,24 +85,33 @@ class MotionRecorder(threading.Thread):
 		"""
 		Sets up PiCamera to record H.264 High/4.1 profile video with enough intra frames that there is
 		at least one in the in-memory circular buffer when motion is detected.
+		A recorder sharing another's camera records from its own splitter port, resized to its configured size.
 		"""
-		logger.info('Starting camera')
 		camera_settings = self.config.camera
-		self.camera = PiCamera(clock_mode='raw', sensor_mode=camera_settings.sensor_mode,
-		                       resolution=(self.width, self.height), framerate=camera_settings.framerate)
-		self.stream = PiCameraCircularIO(self.camera, seconds=self.seconds_pre + 1, bitrate=camera_settings.bitrate)
+		resize = None
+		if self.owns_camera:
+			logger.info(f'Starting camera {self.config.camera_num}')
+			self.camera = PiCamera(camera_num=self.config.camera_num, clock_mode='raw', sensor_mode=camera_settings.sensor_mode,
+			                       resolution=(self.width, self.height), framerate=camera_settings.framerate)
+		else:
+			logger.info(f'Sharing camera {self.config.camera_num} on splitter port {self.splitter_port}')
+			resize = (self.width, self.height)
+		self.stream = PiCameraCircularIO(self.camera, seconds=self.seconds_pre + 1, bitrate=camera_settings.bitrate,
+		                                 splitter_port=self.splitter_port)
 		self.motion = MotionVectorReader(self.camera, boot_timestamp=int(self.boot_time.timestamp() * 1000000),
-		                                 pre_frames=self.seconds_pre * camera_settings.framerate, config=self.config)
-		self.camera.start_recording(self.stream, motion_output=self.motion,
+		                                 pre_frames=self.seconds_pre * camera_settings.framerate, config=self.config,
+		                                 size=resize, splitter_port=self.splitter_port)
+		self.camera.start_recording(self.stream, motion_output=self.motion, splitter_port=self.splitter_port, resize=resize,
 		                            format='h264', profile='high', level='4.1', bitrate=camera_settings.bitrate,
 		                            intra_period=self.seconds_pre * camera_settings.framerate // 2)
-		try:
-			apply_camera_settings(self.camera, camera_settings)
-		except AttributeError as e:
-			logger.warning(str(e))
+		if self.owns_camera:
+			try:
+				apply_camera_settings(self.camera, camera_settings)
+			except AttributeError as e:
+				logger.warning(str(e))
 
 		logger.info('Waiting for camera to warm up...')
-		self.camera.wait_recording(2)  # Give camera some time to start up
+		self.camera.wait_recording(2, splitter_port=self.splitter_port)  # Give camera some time to start up
 		self.motion.clear_trigger()    # then clear the triggered.
 		self.motion.clear_statistics()
 
@@ -104,7 +121,7 @@ class MotionRecorder(threading.Thread):
 		Main loop of the motion recorder. Waits for trigger from the motion detector async task
 		and writes in-memory circular buffer to file every time it happens, until motion detection trigger.
 		After each recording, info is posted to captures queue, where whatever is consuming the recordings
-		can pick it up.
+		can pick it up. Each item is a tuple of this recorder's config, the `CaptureInfo` and the list of `FrameStats`.
 		"""
 		while self.camera.recording:
 			if self.motion.wait(self.seconds_pre):
@@ -115,6 +132,7 @@ class MotionRecorder(threading.Thread):
 
 					# Start a new video, then append circular buffer to it until motion ends
 					name = start_time.strftime(self.file_pattern)
+					self.capturing = True
 					with io.open(self.output_dir.joinpath(Path(name + '.h264')).absolute(), 'wb') as output:
 						logger.info('Started writing video file')
 						last_motion_time = self.get_camera_time()
@@ -131,16 +149,19 @@ class MotionRecorder(threading.Thread):
 							if (self.boot_time + current_time) - start_time > timedelta(seconds=self.max_recording_time):
 								logger.info('Max recording time reached')
 								break
+					self.capturing = False
 					logger.info('Finished writing video file')
 					end_time = self.boot_time + self.get_camera_time()
 					motion_stats = self.motion.stop_capturing_and_get_stats()
 					max_motion = max(motion_stats, key=lambda each: each.motion_sum).motion_sum
 					max_sad = max(motion_stats, key=lambda each: each.sad_sum).sad_sum
 					self.captures.put(
-						(CaptureInfo(name, int(start_time.timestamp() * 1000000), (end_time - start_time).total_seconds(), max_motion, max_sad),
+						(self.config,
+						 CaptureInfo(name, int(start_time.timestamp() * 1000000), (end_time - start_time).total_seconds(), max_motion, max_sad),
 						 motion_stats)
 					)
 				except PiCameraError as e:
+					self.capturing = False
 					logger.error('Could not save recording: ' + e)
 					pass
 				# Wait for the circular buffer to fill up before looping again
@@ -166,19 +187,3 @@ class MotionRecorder(threading.Thread):
 		"""With clock_mode='raw' (see `start_camera`), camera's timestamp is microseconds since system boot."""
 		return timedelta(microseconds=self.camera.timestamp)
 
-
-def get_camera_settings(camera: PiCamera, settings):
-	"""
-	Return a dict containing the values of the settings in the given list
-	"""
-	return {key: getattr(camera, key) for key in settings if key not in CAMERA_SETTINGS_TO_IGNORE}
-
-
-def apply_camera_settings(camera: PiCamera, settings: dict):
-	"""
-	Iterate over all the settings in the given dictionary and set the property with the same name in the camera object
-	"""
-	for key in settings:
-		if key in CAMERA_SETTINGS_TO_IGNORE or settings[key] is None:
-			continue
-		setattr(camera, key, settings[key])
\ No newline at end of file
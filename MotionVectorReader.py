@@ -16,10 +16,15 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
 	Numpy is fast enough for that.
 	"""
 
-	def __init__(self, camera, boot_timestamp, pre_frames, config: OmegaConf):
-		"""Initialize motion vector reader"""
-		super(type(self), self).__init__(camera)
+	def __init__(self, camera, boot_timestamp, pre_frames, config: OmegaConf, size=None, splitter_port=1):
+		"""
+		Initialize motion vector reader.
+		`size` is the resized (width, height) being recorded, if different from the camera's resolution.
+		`splitter_port` is the port being recorded from, whose encoder gives the time of each frame.
+		"""
+		super(type(self), self).__init__(camera, size)
 		self.camera = camera
+		self.splitter_port = splitter_port
 		self.boot_timestamp = boot_timestamp   # Microseconds, UTC. Needed to calculate absolute time of each frame
 		self.per_block_threshold = config.per_block_threshold
 		self.num_threshold_blocks = config.num_threshold_blocks
@@ -71,7 +76,12 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
 		Sets `self.trigger` event to trigger capture.
 		"""
 
-		frame_time = self.camera.frame.timestamp
+		# PiCamera.frame is the frame of whichever encoder happens to be first when recording from more than one
+		# splitter port, so get it from the encoder for this recorder's port instead.
+		encoder = self.camera._encoders.get(self.splitter_port)
+		if encoder is None:   # Recording has stopped
+			return
+		frame_time = encoder.frame.timestamp
 		if frame_time is None:   # PiCamera documentation says timestamp can occasionally be "unknown"
 			return
 
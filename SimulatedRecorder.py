@@ -0,0 +1,163 @@
+import time
+import queue
+import random
+import threading
+import subprocess
+import logging
+from datetime import datetime, timezone
+from omegaconf import OmegaConf
+from PIL import Image, ImageDraw
+
+from data import CaptureInfo, FrameStats
+from camera_settings import apply_camera_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedCamera:
+	"""
+	Stand-in for picamerax.PiCamera, providing just enough for the web server's live preview and camera controls.
+	Preview frames are a moving box on a gradient, overlaid with the annotate text.
+	"""
+
+	AWB_MODES = ('off', 'auto', 'sunlight', 'cloudy', 'shade', 'tungsten', 'fluorescent', 'incandescent', 'flash', 'horizon')
+	EXPOSURE_MODES = ('off', 'auto', 'night', 'nightpreview', 'backlight', 'spotlight', 'sports', 'snow', 'beach',
+	                  'verylong', 'fixedfps', 'antishake', 'fireworks')
+
+	def __init__(self, settings):
+		self.resolution = (settings.width, settings.height)
+		self.framerate = settings.framerate
+		self.awb_mode = 'auto'
+		self.exposure_mode = 'auto'
+		self.exposure_compensation = 0
+		self.brightness = 50
+		self.contrast = 0
+		self.saturation = 0
+		self.iso = 0
+		self.sharpness = 0
+		self.hflip = False
+		self.vflip = False
+		self.rotation = 0
+		self.video_denoise = True
+		self.annotate_text_size = 32
+		self.annotate_text = ''
+		self.recording = True
+		apply_camera_settings(self, settings)
+
+
+	def close(self):
+		self.recording = False
+
+
+	def capture_continuous(self, output, format='jpeg', use_video_port=True):
+		"""Write a JPEG preview frame to `output` at the camera's frame rate, yielding after each one."""
+		width, height = self.resolution
+		background = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+		box_size = height // 4
+		frame_num = 0
+		while self.recording:
+			image = background.copy()
+			draw = ImageDraw.Draw(image)
+			x = (frame_num * 8) % max(1, width - box_size)
+			draw.rectangle((x, height // 2 - box_size // 2, x + box_size, height // 2 + box_size // 2), fill=(255, 255, 0))
+			draw.text((10, 10), self.annotate_text, fill=(255, 255, 255))
+			image.save(output, format=format)
+			yield output
+			frame_num += 1
+			time.sleep(1.0 / self.framerate)
+
+
+class SimulatedRecorder(threading.Thread):
+	"""
+	Replacement for MotionRecorder which needs no camera hardware, for testing the rest of the application.
+	Simulates a motion event every so often, generating a test pattern video with ffmpeg and random motion
+	statistics, and posts them to the captures queue in the same way MotionRecorder does.
+	"""
+
+	def __init__(self, config: OmegaConf, captures: queue.Queue = None):
+		super().__init__(daemon=True)
+		self.name = config.name
+		self.camera = None
+		self.config = config
+		self.width = config.camera.width
+		self.height = config.camera.height
+		self.framerate = config.camera.framerate
+		self.seconds_pre = config.seconds_pre
+		self.seconds_post = config.seconds_post
+		self.max_recording_time = config.max_recording_time
+		self.file_pattern = '%Y-%m-%dT%H-%M-%S'
+		self.label_pattern = '%Y-%m-%d %H:%M'
+		self.output_dir = config.staging_dir
+		self.captures = captures if captures is not None else queue.Queue()
+		self.stopped = threading.Event()
+		self.capturing = False   # Whether a video file is being written
+
+
+	def __enter__(self):
+		self.camera = SimulatedCamera(self.config.camera)
+		self.camera.annotate_text = time.strftime(self.label_pattern)
+		logger.info(f'Simulated recorder "{self.name}" ready')
+		return self
+
+
+	def __exit__(self, type, value, traceback):
+		self.camera.close()
+		self.stopped.set()
+
+
+	def run(self):
+		"""
+		Main loop of the simulated recorder. Waits a random amount of time, then "records" for as long as
+		the simulated motion lasts plus the pre and post recording times.
+		"""
+		while not self.stopped.wait(random.uniform(self.seconds_pre, self.seconds_pre + self.seconds_post)):
+			self.camera.annotate_text = time.strftime(self.label_pattern)
+			start_time = datetime.now(timezone.utc)
+			motion_seconds = random.uniform(1, self.seconds_post)
+			length_seconds = min(self.seconds_pre + motion_seconds + self.seconds_post, self.max_recording_time)
+			self.capturing = True
+			if self.stopped.wait(length_seconds):
+				break
+
+			name = start_time.strftime(self.file_pattern)
+			video_path = self.output_dir.joinpath(f'{name}.h264').absolute()
+			logger.info('Started writing simulated video file')
+			try:
+				subprocess.run(['ffmpeg', '-y', '-f', 'lavfi',
+				                '-i', f'testsrc=size={self.width}x{self.height}:rate={self.framerate}:duration={length_seconds:.3f}',
+				                '-c:v', 'libx264', '-f', 'h264', str(video_path)],
+				               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+			except (OSError, subprocess.CalledProcessError) as e:
+				logger.error(f'Could not generate simulated video. {e}')
+				continue
+			finally:
+				self.capturing = False
+			logger.info('Finished writing simulated video file')
+
+			start_timestamp = int(start_time.timestamp() * 1000000)
+			motion_stats = self.make_frame_stats(start_timestamp, length_seconds, motion_seconds)
+			max_motion = max(motion_stats, key=lambda each: each.motion_sum).motion_sum
+			max_sad = max(motion_stats, key=lambda each: each.sad_sum).sad_sum
+			self.captures.put(
+				(self.config,
+				 CaptureInfo(name, start_timestamp, length_seconds, max_motion, max_sad),
+				 motion_stats)
+			)
+
+
+	def make_frame_stats(self, start_timestamp, length_seconds, motion_seconds) -> list[FrameStats]:
+		"""Random per-frame statistics, low outside of the motion period and above the thresholds within it."""
+		frame_time = 1000000 // self.framerate
+		motion_start = self.seconds_pre * self.framerate
+		motion_end = motion_start + int(motion_seconds * self.framerate)
+		stats = []
+		for i in range(int(length_seconds * self.framerate)):
+			if motion_start <= i < motion_end:
+				max_motion = random.randint(self.config.per_block_threshold, self.config.per_block_upper_bound)
+				motion_sum = random.randint(self.config.per_frame_threshold, self.config.per_frame_upper_bound)
+			else:
+				max_motion = random.randint(0, self.config.per_block_threshold // 2)
+				motion_sum = random.randint(0, self.config.per_frame_threshold // 2)
+			stats.append(FrameStats(start_timestamp + i * frame_time, max_motion, motion_sum, random.randint(10000, 100000)))
+		return stats
@@ -0,0 +1,475 @@
+import io
+import os
+import sys
+import asyncio
+import threading
+import logging
+import mimetypes
+from dataclasses import dataclass
+from datetime import timedelta
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, parse_qsl
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, parse_range_header
+from werkzeug.routing import RequestRedirect
+from werkzeug.security import safe_join
+
+from export import create_export, export_file_name
+
+
+logger = logging.getLogger(__name__)
+
+KEEP_ALIVE_TIMEOUT = 15   # Seconds to wait for the next request on an idle connection
+FRAME_TIMEOUT = 5         # Seconds to wait for a live stream frame before checking that frames are still being captured
+MAX_HEADER_SIZE = 16384
+MAX_BODY_SIZE = 65536     # Only the camera controls send a body, which is a small bit of JSON
+GRAPH_ENDPOINTS = {
+	'max_motion_graph': 'get_max_motion_image',
+	'motion_sum_graph': 'get_motion_sum_image',
+	'sad_sum_graph': 'get_sad_sum_image',
+}
+
+
+@dataclass
+class Request:
+	method: str
+	path: str
+	query: str
+	version: str
+	headers: dict   # Lower case header names
+	body: bytes
+
+	@property
+	def keep_alive(self):
+		connection = self.headers.get('connection', '').lower()
+		if self.version == 'HTTP/1.0':
+			return connection == 'keep-alive'
+		return connection != 'close'
+
+
+class RequestError(Exception):
+	"""A request that is refused before being read completely. The connection is closed after the response."""
+
+	def __init__(self, status: HTTPStatus, message: str):
+		super().__init__(message)
+		self.status = status
+		self.message = message
+
+
+class FrameBroadcaster:
+	"""
+	Captures JPEG frames from a camera on a background thread for as long as anyone is watching, and hands the
+	latest frame to each viewer. A viewer that can't keep up skips frames rather than having them queue up.
+	"""
+
+	def __init__(self, camera, loop: asyncio.AbstractEventLoop):
+		self.camera = camera
+		self.loop = loop
+		self.frame = None
+		self.frame_id = 0
+		self.new_frame = asyncio.Event()
+		self.viewers = 0
+		self.lock = threading.Lock()
+		self.thread = None
+
+
+	def add_viewer(self):
+		with self.lock:
+			self.viewers += 1
+		self.start_capture()
+
+
+	def remove_viewer(self):
+		with self.lock:
+			self.viewers -= 1
+
+
+	def start_capture(self):
+		"""Start the capture thread if there are viewers and it isn't already running"""
+		with self.lock:
+			if self.thread is None and self.viewers > 0:
+				self.thread = threading.Thread(name='broadcast', target=self.capture, daemon=True)
+				self.thread.start()
+
+
+	def capture(self):
+		stream = io.BytesIO()
+		logger.info('Sending live preview')
+		try:
+			for _ in self.camera.capture_continuous(stream, format='jpeg', use_video_port=True):
+				with self.lock:
+					if self.viewers == 0:
+						self.thread = None
+						break
+				data = stream.getvalue()
+				if data:
+					self.loop.call_soon_threadsafe(self.publish, data)
+				stream.seek(0)
+				stream.truncate()
+		except Exception as e:
+			logger.error(f'Failed to provide MJPEG stream. {e}')
+		finally:
+			with self.lock:
+				if self.thread is threading.current_thread():
+					self.thread = None
+			logger.info('Stopped sending preview')
+
+
+	def publish(self, frame: bytes):
+		self.frame = frame
+		self.frame_id += 1
+		self.new_frame.set()
+		self.new_frame = asyncio.Event()
+
+
+	async def next_frame(self, last_id):
+		"""Wait for a frame newer than `last_id`, then return it and its id"""
+		while self.frame is None or self.frame_id == last_id:
+			try:
+				await asyncio.wait_for(self.new_frame.wait(), FRAME_TIMEOUT)
+			except asyncio.TimeoutError:
+				self.start_capture()   # In case capturing stopped, e.g. after an error
+		return self.frame, self.frame_id
+
+
+class AsyncServer:
+	"""
+	Serves the web app from an asyncio event loop, so that long-lived responses don't each hold a thread.
+	Live streams, video downloads and graph images are handled here directly: streams wait on the client
+	(so slow viewers skip frames), and files are sent with sendfile and support Range requests.
+	Everything else is passed to the Flask app on a small pool of threads.
+	Each kind of request has a limit on how many can run at once. Streams, videos and exports over the limit get a 503,
+	whereas graph images and frame indexes, which are small and needed by the pages, wait their turn.
+	"""
+
+	def __init__(self, app, max_streams: int, max_downloads: int, max_pages: int):
+		self.app = app
+		self.url_adapter = app.url_map.bind('localhost')
+		self.recorders = app.extensions['recorders']
+		self.graphers = app.extensions['graphers']
+		self.frame_indexers = app.extensions['frame_indexers']
+		self.export_throttle = app.extensions['export_throttle']
+		self.stream_slots = asyncio.Semaphore(max_streams)
+		self.download_slots = asyncio.Semaphore(max_downloads)
+		self.small_file_slots = asyncio.Semaphore(max_downloads)   # Graphs and frame indexes, kept apart so they aren't held up by videos
+		self.executor = ThreadPoolExecutor(max_workers=max_pages, thread_name_prefix='page')
+		self.broadcasters = {}
+		self.loop = None
+		self.host = None
+		self.port = None
+
+
+	async def serve(self, host, port):
+		self.loop = asyncio.get_running_loop()
+		self.host = host
+		self.port = port
+		server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_SIZE)
+		async with server:
+			await server.serve_forever()
+
+
+	async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		try:
+			while True:
+				try:
+					request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT)
+				except asyncio.TimeoutError:
+					break
+				except RequestError as e:
+					write_error(writer, e.status, e.message, keep_alive=False)
+					await writer.drain()
+					break
+				except (ValueError, asyncio.LimitOverrunError):
+					write_error(writer, HTTPStatus.BAD_REQUEST, 'Malformed request', keep_alive=False)
+					await writer.drain()
+					break
+				if request is None:
+					break
+				keep_alive = await self.handle_request(request, writer)
+				await writer.drain()
+				if not keep_alive:
+					break
+		except ConnectionError:
+			# Client went away, e.g. closed the page or the browser cancelled a range request
+			pass
+		except Exception as e:
+			logger.error(f'Error handling request. {e}')
+		finally:
+			writer.close()
+
+
+	async def handle_request(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+		"""Send the response to the request. Returns whether the connection can be used for another request."""
+		try:
+			endpoint, values = self.url_adapter.match(request.path, request.method)
+		except (HTTPException, RequestRedirect):
+			endpoint, values = None, {}
+
+		recorder = self.recorders.get(values.get('camera'))
+		if recorder is None:
+			# Includes unknown cameras, so the app can give its usual error page
+			return await self.call_app(request, writer)
+		if endpoint == 'live_stream':
+			return await self.send_stream(request, writer, recorder)
+		if endpoint == 'download_capture':
+			path = safe_join(str(recorder.config.video_dir), values['name'] + '.mp4')
+			return await self.send_file(request, writer, path, self.download_slots)
+		if endpoint in GRAPH_ENDPOINTS:
+			grapher = self.graphers[recorder.name]
+			# Graph images are made on first request, which is too slow to do on the event loop
+			path = await self.loop.run_in_executor(self.executor, getattr(grapher, GRAPH_ENDPOINTS[endpoint]), values['name'])
+			return await self.send_file(request, writer, path, self.small_file_slots, max_age=timedelta(days=365), wait=True)
+		if endpoint == 'frame_index':
+			indexer = self.frame_indexers[recorder.name]
+			path = await self.loop.run_in_executor(self.executor, indexer.get_frame_index, values['name'])
+			return await self.send_file(request, writer, path, self.small_file_slots, max_age=timedelta(days=365), wait=True)
+		if endpoint == 'export_captures':
+			return await self.send_export(request, writer, recorder)
+		return await self.call_app(request, writer)
+
+
+	async def send_stream(self, request: Request, writer: asyncio.StreamWriter, recorder) -> bool:
+		"""Live MJPEG stream. The connection is closed at the end."""
+		if recorder.camera is None:
+			write_error(writer, HTTPStatus.SERVICE_UNAVAILABLE, 'Camera is not running', keep_alive=False)
+			return False
+		if self.stream_slots.locked():
+			write_error(writer, HTTPStatus.SERVICE_UNAVAILABLE, 'Too many live stream viewers', keep_alive=False)
+			return False
+
+		async with self.stream_slots:
+			write_head(writer, HTTPStatus.OK, [('Content-Type', 'multipart/x-mixed-replace; boundary=frame'),
+			                                   ('Cache-Control', 'no-cache')], keep_alive=False)
+			if request.method == 'HEAD':
+				return False
+
+			broadcaster = self.broadcasters.get(recorder.camera)
+			if broadcaster is None:
+				broadcaster = self.broadcasters[recorder.camera] = FrameBroadcaster(recorder.camera, self.loop)
+			broadcaster.add_viewer()
+			try:
+				frame_id = None
+				while True:
+					frame, frame_id = await broadcaster.next_frame(frame_id)
+					writer.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+					await writer.drain()   # Waits while the client is behind, so frames in between are skipped
+			finally:
+				broadcaster.remove_viewer()
+				logger.info('Client disconnected from live stream')
+
+
+	async def send_file(self, request: Request, writer: asyncio.StreamWriter, path, slots: asyncio.Semaphore,
+	                    max_age: timedelta = None, wait=False) -> bool:
+		"""
+		Send a file with sendfile, or the part of it asked for by a Range header.
+		If all of `slots` are in use, either wait for one or send a 503.
+		"""
+		keep_alive = request.keep_alive
+		try:
+			file = open(path, 'rb') if path is not None else None
+		except OSError:
+			file = None
+		if file is None:
+			logger.warning(f'The file {path} does not exist')
+			write_error(writer, HTTPStatus.NOT_FOUND, 'File not found', keep_alive)
+			return keep_alive
+		if slots.locked() and not wait:
+			file.close()
+			write_error(writer, HTTPStatus.SERVICE_UNAVAILABLE, 'Too many downloads', keep_alive)
+			return keep_alive
+
+		async with slots:
+			with file:
+				stat = os.fstat(file.fileno())
+				size = stat.st_size
+				content_type = mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+				headers = [('Content-Type', content_type), ('Accept-Ranges', 'bytes'), ('Last-Modified', http_date(stat.st_mtime))]
+				if max_age is not None:
+					headers.append(('Cache-Control', f'public, max-age={int(max_age.total_seconds())}'))
+
+				part = get_byte_range(request, size)
+				if part is None:
+					write_range_error(writer, size, keep_alive)
+					return keep_alive
+				status, start, end = part
+				if status == HTTPStatus.PARTIAL_CONTENT:
+					headers.append(('Content-Range', f'bytes {start}-{end - 1}/{size}'))
+
+				headers.append(('Content-Length', str(end - start)))
+				write_head(writer, status, headers, keep_alive)
+				if request.method != 'HEAD' and end > start:
+					await writer.drain()
+					await self.loop.sendfile(writer.transport, file, start, end - start)
+		return keep_alive
+
+
+	async def send_export(self, request: Request, writer: asyncio.StreamWriter, recorder) -> bool:
+		"""Zip of captures, made as it's sent. Reading files is done on the default thread pool."""
+		keep_alive = request.keep_alive
+		if self.download_slots.locked():
+			write_error(writer, HTTPStatus.SERVICE_UNAVAILABLE, 'Too many downloads', keep_alive)
+			return keep_alive
+		async with self.download_slots:
+			args = MultiDict(parse_qsl(request.query))
+			try:
+				export = await self.loop.run_in_executor(self.executor, create_export, recorder, self.graphers[recorder.name],
+				                                         args, self.export_throttle)
+			except HTTPException as e:
+				write_error(writer, HTTPStatus(e.code), e.description, keep_alive)
+				return keep_alive
+
+			etag = f'"{export.etag}"'
+			headers = [('Content-Type', 'application/zip'), ('Accept-Ranges', 'bytes'), ('ETag', etag),
+			           ('Content-Disposition', f'attachment; filename="{export_file_name(recorder, args)}"')]
+			part = get_byte_range(request, export.size, etag)
+			if part is None:
+				write_range_error(writer, export.size, keep_alive)
+				return keep_alive
+			status, start, end = part
+			if status == HTTPStatus.PARTIAL_CONTENT:
+				headers.append(('Content-Range', f'bytes {start}-{end - 1}/{export.size}'))
+			headers.append(('Content-Length', str(end - start)))
+			write_head(writer, status, headers, keep_alive)
+			if request.method == 'HEAD':
+				return keep_alive
+
+			chunks = export.iter_bytes(start, end)
+			try:
+				while (data := await self.loop.run_in_executor(None, next, chunks, None)) is not None:
+					writer.write(data)
+					await writer.drain()
+			finally:
+				chunks.close()
+		return keep_alive
+
+
+	async def call_app(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+		"""Pass the request to the Flask app, on the thread pool"""
+		status, headers, body = await self.loop.run_in_executor(self.executor, self.run_app, self.make_environ(request, writer))
+		headers = [(name, value) for name, value in headers if name.lower() != 'connection']
+		if not any(name.lower() == 'content-length' for name, _ in headers):
+			headers.append(('Content-Length', str(len(body))))
+		keep_alive = request.keep_alive
+		write_head(writer, status, headers, keep_alive)
+		writer.write(body)
+		return keep_alive
+
+
+	def run_app(self, environ):
+		response = {}
+
+		def start_response(status, headers, exc_info=None):
+			response['status'] = status
+			response['headers'] = headers
+
+		result = self.app(environ, start_response)
+		try:
+			body = b''.join(result)
+		finally:
+			if hasattr(result, 'close'):
+				result.close()
+		return response['status'], response['headers'], body
+
+
+	def make_environ(self, request: Request, writer: asyncio.StreamWriter):
+		peer = writer.get_extra_info('peername') or ('', 0)
+		environ = {
+			'REQUEST_METHOD': request.method,
+			'SCRIPT_NAME': '',
+			'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+			'QUERY_STRING': request.query,
+			'SERVER_NAME': self.host,
+			'SERVER_PORT': str(self.port),
+			'SERVER_PROTOCOL': request.version,
+			'REMOTE_ADDR': peer[0],
+			'REMOTE_PORT': str(peer[1]),
+			'wsgi.version': (1, 0),
+			'wsgi.url_scheme': 'http',
+			'wsgi.input': io.BytesIO(request.body),
+			'wsgi.errors': sys.stderr,
+			'wsgi.multithread': True,
+			'wsgi.multiprocess': False,
+			'wsgi.run_once': False,
+		}
+		for name, value in request.headers.items():
+			key = name.upper().replace('-', '_')
+			if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+				environ[key] = value
+			else:
+				environ['HTTP_' + key] = value
+		return environ
+
+
+async def read_request(reader: asyncio.StreamReader):
+	"""Read the next request from the connection, or return None if the client closed it"""
+	try:
+		head = await reader.readuntil(b'\r\n\r\n')
+	except asyncio.IncompleteReadError:
+		return None
+
+	lines = head.decode('latin-1').split('\r\n')
+	method, target, version = lines[0].split(' ')
+	headers = {}
+	for line in lines[1:]:
+		if line:
+			name, _, value = line.partition(':')
+			headers[name.strip().lower()] = value.strip()
+	path, _, query = target.partition('?')
+
+	if 'chunked' in headers.get('transfer-encoding', '').lower():
+		raise RequestError(HTTPStatus.LENGTH_REQUIRED, 'Chunked request bodies are not supported')
+	body = b''
+	length = int(headers.get('content-length', 0))
+	if length > MAX_BODY_SIZE:
+		raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Request body is too large')
+	if length:
+		try:
+			body = await reader.readexactly(length)
+		except asyncio.IncompleteReadError:
+			return None
+	return Request(method, unquote(path), query, version, headers, body)
+
+
+def get_byte_range(request: Request, size, etag=None):
+	"""
+	The part of a response of `size` bytes asked for by the request's Range header, as (status, start, end).
+	Multiple ranges are not supported, so they're ignored and the whole thing is sent, as it is if an If-Range
+	doesn't match `etag`. Returns None if the range can't be satisfied.
+	"""
+	byte_range = parse_range_header(request.headers.get('range'))
+	if byte_range is None or len(byte_range.ranges) != 1 or request.headers.get('if-range', etag) != etag:
+		return HTTPStatus.OK, 0, size
+	part = byte_range.range_for_length(size)
+	if part is None:
+		return None
+	return HTTPStatus.PARTIAL_CONTENT, part[0], part[1]
+
+
+def write_head(writer: asyncio.StreamWriter, status, headers, keep_alive):
+	if isinstance(status, HTTPStatus):
+		status = f'{status.value} {status.phrase}'
+	lines = [f'HTTP/1.1 {status}']
+	lines += [f'{name}: {value}' for name, value in headers]
+	lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+	writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+
+def write_error(writer: asyncio.StreamWriter, status: HTTPStatus, message: str, keep_alive, headers=()):
+	body = message.encode('utf-8')
+	write_head(writer, status, [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body))), *headers], keep_alive)
+	writer.write(body)
+
+
+def write_range_error(writer: asyncio.StreamWriter, size, keep_alive):
+	write_error(writer, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, 'Range not satisfiable', keep_alive, [('Content-Range', f'bytes */{size}')])
+
+
+def run(app, host, port, max_streams, max_downloads, max_pages):
+	logger.info('Starting async web server...')
+	server = AsyncServer(app, max_streams, max_downloads, max_pages)
+	thread = threading.Thread(name='webserver', target=lambda: asyncio.run(server.serve(host, port)), daemon=True)
+	thread.start()
+	logger.info(f'Async web server is running on port {port}')
+	return thread
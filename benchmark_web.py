@@ -0,0 +1,178 @@
+"""
+Load benchmark for the web server, with simulated live stream viewers and video downloaders.
+Runs the server in a separate process with a simulated camera, once for each server type, and reports
+frame and download rates along with the server's threads and memory use while under load.
+
+> python benchmark_web.py --viewers 20 --downloads 10 --seconds 10
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from omegaconf import OmegaConf
+
+from data import CaptureInfo
+
+
+BOUNDARY = b'--frame\r\n'
+
+
+def serve(server_type, port, directory: Path):
+	""" Run the web server with a simulated recorder, until killed. """
+	import webserver
+	import asyncserver
+	from SimulatedRecorder import SimulatedRecorder
+
+	config = OmegaConf.create({
+		'name': 'bench',
+		'camera': {'width': 640, 'height': 480, 'framerate': 15},
+		'staging_dir': directory, 'video_dir': directory, 'data_dir': directory,
+		'seconds_pre': 10, 'seconds_post': 60, 'max_recording_time': 300,
+		'per_block_threshold': 50, 'per_frame_threshold': 1500,
+		'per_block_upper_bound': 100, 'per_frame_upper_bound': 50000, 'scale_boost': 20, 'export_max_rate': 2.0,
+	})
+	with SimulatedRecorder(config) as recorder:
+		app = webserver.create([recorder], config)
+		if server_type == 'async':
+			thread = asyncserver.run(app, host='127.0.0.1', port=port, max_streams=1000, max_downloads=1000, max_pages=2)
+		else:
+			thread = webserver.run(app, host='127.0.0.1', port=port)
+		thread.join()
+
+
+async def open_request(port, path, headers=''):
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n{headers}\r\n'.encode('latin-1'))
+	await writer.drain()
+	await reader.readuntil(b'\r\n\r\n')
+	return reader, writer
+
+
+async def viewer(port, end_time):
+	""" Watch the live stream, counting frames. Returns the number of frames. """
+	frames = 0
+	reader, writer = await open_request(port, '/bench/live/stream')
+	try:
+		while time.monotonic() < end_time:
+			data = await asyncio.wait_for(reader.read(65536), timeout=max(0.1, end_time - time.monotonic()))
+			if not data:
+				break
+			frames += data.count(BOUNDARY)
+	except asyncio.TimeoutError:
+		pass
+	finally:
+		writer.close()
+	return frames
+
+
+async def downloader(port, end_time, file_size, chunk_size):
+	""" Repeatedly download random ranges of the video file, the way a browser does when seeking. Returns bytes received. """
+	received = 0
+	while time.monotonic() < end_time:
+		start = random.randrange(0, file_size - chunk_size)
+		reader, writer = await open_request(port, '/bench/captures/download/video', f'Range: bytes={start}-{start + chunk_size - 1}\r\n')
+		try:
+			while data := await reader.read(65536):
+				received += len(data)
+		finally:
+			writer.close()
+	return received
+
+
+async def page_prober(port, end_time):
+	""" Time how long the captures page takes to load while everything else is going on. Returns a list of seconds. """
+	times = []
+	while time.monotonic() < end_time:
+		started = time.monotonic()
+		reader, writer = await open_request(port, '/bench/captures')
+		await reader.read()
+		writer.close()
+		times.append(time.monotonic() - started)
+		await asyncio.sleep(0.5)
+	return times
+
+
+def read_process_status(pid):
+	status = {}
+	for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+		key, _, value = line.partition(':')
+		status[key] = value.strip()
+	return int(status['Threads']), int(status['VmRSS'].split()[0])
+
+
+async def run_load(port, pid, args, file_size):
+	end_time = time.monotonic() + args.seconds
+	tasks = [asyncio.create_task(viewer(port, end_time)) for _ in range(args.viewers)]
+	tasks += [asyncio.create_task(downloader(port, end_time, file_size, args.chunk_size)) for _ in range(args.downloads)]
+	prober = asyncio.create_task(page_prober(port, end_time))
+
+	max_threads = max_rss = 0
+	while time.monotonic() < end_time:
+		threads, rss = read_process_status(pid)
+		max_threads = max(max_threads, threads)
+		max_rss = max(max_rss, rss)
+		await asyncio.sleep(0.25)
+
+	results = await asyncio.gather(*tasks)
+	page_times = await prober
+	frames = results[:args.viewers]
+	downloaded = sum(results[args.viewers:])
+	return {
+		'frames_per_viewer': sum(frames) / max(1, len(frames)) / args.seconds,
+		'min_frames_per_viewer': min(frames, default=0) / args.seconds,
+		'download_mb_per_second': downloaded / args.seconds / 1e6,
+		'page_load_ms': 1000 * sum(page_times) / max(1, len(page_times)),
+		'max_threads': max_threads,
+		'max_rss_mb': max_rss / 1024,
+	}
+
+
+def benchmark(server_type, port, args, directory: Path, file_size):
+	server = subprocess.Popen([sys.executable, __file__, '--serve', server_type, '--port', str(port), '--dir', str(directory)])
+	try:
+		time.sleep(2)   # Give the server time to start
+		return asyncio.run(run_load(port, server.pid, args, file_size))
+	finally:
+		server.kill()
+		server.wait()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--server', choices=['threaded', 'async', 'both'], default='both')
+	parser.add_argument('--viewers', type=int, default=20, help='Number of live stream viewers')
+	parser.add_argument('--downloads', type=int, default=10, help='Number of clients downloading the video')
+	parser.add_argument('--seconds', type=int, default=10, help='How long to run each benchmark')
+	parser.add_argument('--file-size', type=int, default=50, help='Size of the video file in MB')
+	parser.add_argument('--chunk-size', type=int, default=1024 * 1024, help='Bytes in each range request')
+	parser.add_argument('--port', type=int, default=8090)
+	parser.add_argument('--serve', choices=['threaded', 'async'], help=argparse.SUPPRESS)
+	parser.add_argument('--dir', type=Path, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.serve:
+		serve(args.serve, args.port, args.dir)
+		return
+
+	server_types = ['threaded', 'async'] if args.server == 'both' else [args.server]
+	with tempfile.TemporaryDirectory() as directory:
+		directory = Path(directory)
+		file_size = args.file_size * 1000000
+		with open(directory / 'video.mp4', 'wb') as f:
+			f.write(os.urandom(file_size))
+		CaptureInfo('video', int(time.time() * 1000000), 60.0, 1000, 100000).write_to_file(directory)
+		print(f'{args.viewers} viewers, {args.downloads} downloaders, {args.seconds} seconds')
+		print(f'{"server":<10} {"fps/viewer":>10} {"min fps":>8} {"MB/s":>8} {"page ms":>8} {"threads":>8} {"RSS MB":>8}')
+		for i, server_type in enumerate(server_types):
+			r = benchmark(server_type, args.port + i, args, directory, file_size)
+			print(f'{server_type:<10} {r["frames_per_viewer"]:>10.1f} {r["min_frames_per_viewer"]:>8.1f} {r["download_mb_per_second"]:>8.1f} '
+			      f'{r["page_load_ms"]:>8.1f} {r["max_threads"]:>8} {r["max_rss_mb"]:>8.1f}')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,19 @@
+# These settings must be explicitly set when setting up the camera and cannot be changed after
+CAMERA_SETTINGS_TO_IGNORE = {'width', 'height', 'sensor_mode', 'framerate', 'bitrate'}
+
+
+def get_camera_settings(camera, settings):
+	"""
+	Return a dict containing the values of the settings in the given list
+	"""
+	return {key: getattr(camera, key) for key in settings if key not in CAMERA_SETTINGS_TO_IGNORE}
+
+
+def apply_camera_settings(camera, settings: dict):
+	"""
+	Iterate over all the settings in the given dictionary and set the property with the same name in the camera object
+	"""
+	for key in settings:
+		if key in CAMERA_SETTINGS_TO_IGNORE or settings[key] is None:
+			continue
+		setattr(camera, key, settings[key])
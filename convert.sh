@@ -1,9 +1,10 @@
 #!/bin/bash
 
-# Wrap h264 in a container with appropriate fps, then delete original file
+# Wrap h264 in a container with appropriate fps, then delete original file.
+# The moov atom is moved to the start (faststart) so that players can begin without reading the end of the file.
 input="$1"
 output="$2"
 frame_rate="$3"
 
-ffmpeg -r "$frame_rate" -i "$input" -vcodec copy "$output" >/dev/null 2>&1
+ffmpeg -r "$frame_rate" -i "$input" -vcodec copy -movflags +faststart "$output" >/dev/null 2>&1
 rm -rf "$input"
\ No newline at end of file
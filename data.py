@@ -28,6 +28,29 @@ class FrameStats:
 		s.write(struct.pack('<QIII', self.timestamp, self.max_motion, self.motion_sum, self.sad_sum))
 
 
+@dataclass
+class FrameIndexEntry:
+	VERSION = 2
+	SIZE = 25
+
+	pts: int           # Presentation time in microseconds from the start of the video
+	offset: int        # Byte offset of the frame's data in the MP4 file
+	size: int          # Size in bytes of the frame's data
+	stats_index: int   # Index of the matching FrameStats, or -1 if there isn't one
+	keyframe: bool
+
+	@classmethod
+	def from_stream(cls, s):
+		data = s.read(cls.SIZE)
+		if not data:
+			return None
+		pts, offset, size, stats_index, keyframe = struct.unpack('<QQIiB', data)
+		return cls(pts, offset, size, stats_index, bool(keyframe))
+
+	def to_stream(self, s):
+		s.write(struct.pack('<QQIiB', self.pts, self.offset, self.size, self.stats_index, self.keyframe))
+
+
 @dataclass
 class CaptureInfo:
 	name: str
@@ -78,4 +101,23 @@ def read_frame_stats(file_path: Path) -> list[FrameStats]:
 				logger.error(f'Unexpected end of file when reading motion data from {file_path.absolute()}')
 				break
 			items.append(fs)
-	return items
\ No newline at end of file
+	return items
+
+
+def write_frame_index(file_path: Path, entries: list[FrameIndexEntry], stats_count: int):
+	with open(file_path, 'wb') as f:
+		f.write(struct.pack('<III', FrameIndexEntry.VERSION, len(entries), stats_count))
+		for entry in entries:
+			entry.to_stream(f)
+
+
+def read_frame_index_version(file_path: Path):
+	"""Version of the frame index file, or None if it doesn't exist or is too short"""
+	try:
+		with open(file_path, 'rb') as f:
+			header = f.read(12)
+	except FileNotFoundError:
+		return None
+	if len(header) < 12:
+		return None
+	return struct.unpack('<III', header)[0]
@@ -0,0 +1,293 @@
+import time
+import zlib
+import struct
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from pathlib import Path
+from werkzeug.exceptions import BadRequest, NotFound
+
+from data import CaptureInfo
+from Grapher import Grapher
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+CRC_CACHE_SIZE = 4096   # Checksums kept for resuming exports. Enough for several days of captures
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_FLAGS = 0x0808   # Data descriptor follows the file data, names are UTF-8
+
+
+@dataclass
+class ZipEntry:
+	name: str   # Name in the archive
+	path: Path
+	size: int
+	mtime_ns: int
+
+	@property
+	def zip64(self):
+		return self.size >= ZIP64_LIMIT
+
+	@property
+	def dos_time(self):
+		t = time.localtime(max(self.mtime_ns // 1000000000, 315532800))   # Zip can't store times before 1980
+		return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+	def local_header(self):
+		name = self.name.encode('utf-8')
+		mod_time, mod_date = self.dos_time
+		if self.zip64:
+			extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+			return struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP64_VERSION, ZIP_FLAGS, 0, mod_time, mod_date,
+			                   0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra)) + name + extra
+		return struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, ZIP_FLAGS, 0, mod_time, mod_date,
+		                   0, 0, 0, len(name), 0) + name
+
+	def data_descriptor(self, crc):
+		if self.zip64:
+			return struct.pack('<IIQQ', 0x08074b50, crc, self.size, self.size)
+		return struct.pack('<IIII', 0x08074b50, crc, self.size, self.size)
+
+	def central_header(self, crc, offset):
+		name = self.name.encode('utf-8')
+		mod_time, mod_date = self.dos_time
+		extra = b''
+		if self.zip64:
+			extra += struct.pack('<QQ', self.size, self.size)
+		if offset >= ZIP64_LIMIT:
+			extra += struct.pack('<Q', offset)
+		if extra:
+			extra = struct.pack('<HH', 1, len(extra)) + extra
+		size = ZIP64_LIMIT if self.zip64 else self.size
+		version = ZIP64_VERSION if extra else ZIP_VERSION
+		return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | ZIP64_VERSION, version, ZIP_FLAGS, 0,
+		                   mod_time, mod_date, crc, size, size, len(name), len(extra), 0, 0, 0,
+		                   0o100644 << 16, min(offset, ZIP64_LIMIT)) + name + extra
+
+
+class ZipStream:
+	"""
+	An uncompressed zip archive of files on disk, produced a chunk at a time so that it is never held in memory
+	or written out anywhere. The layout is worked out up front, so the size is known and any range of bytes
+	can be produced, which allows downloads to be resumed.
+	Checksums are worked out as each file is read. Each stream keeps its own for the central directory at the end,
+	and recent ones are also kept for all streams so that a resumed download doesn't have to read the files again.
+	"""
+
+	crc_cache = OrderedDict()   # (path, size, mtime_ns) -> CRC-32, least recently used first
+	crc_lock = threading.Lock()
+
+	def __init__(self, entries: list[ZipEntry], throttle=None):
+		self.entries = entries
+		self.throttle = throttle
+		self.crcs = {}   # (path, size, mtime_ns) -> CRC-32 of this stream's files
+		self.segments = []   # (offset, length, function producing bytes from start to end of the segment)
+		offset = 0
+		central_size = 0
+		for entry in entries:
+			header = entry.local_header()
+			entry_offset = offset
+			self.add_segment(offset, len(header), lambda start, end, header=header: [header[start:end]])
+			offset += len(header)
+			self.add_segment(offset, entry.size, lambda start, end, entry=entry: self.iter_file(entry, start, end))
+			offset += entry.size
+			descriptor_size = len(entry.data_descriptor(0))
+			self.add_segment(offset, descriptor_size, lambda start, end, entry=entry: [entry.data_descriptor(self.get_crc(entry))[start:end]])
+			offset += descriptor_size
+			central_size += len(entry.central_header(0, entry_offset))
+		self.central_offset = offset
+		self.central_size = central_size
+		end_size = len(self.end_records())
+		self.add_segment(offset, central_size + end_size, lambda start, end: [self.central_directory()[start:end]])
+		self.size = offset + central_size + end_size
+
+		fingerprint = hashlib.sha1()
+		for entry in entries:
+			fingerprint.update(f'{entry.name}:{entry.size}:{entry.mtime_ns}\n'.encode('utf-8'))
+		self.etag = fingerprint.hexdigest()[:20]
+
+
+	def add_segment(self, offset, length, produce):
+		if length > 0:
+			self.segments.append((offset, length, produce))
+
+
+	def iter_bytes(self, start=0, end=None):
+		"""Yield the bytes of the archive from `start` up to but not including `end`"""
+		end = self.size if end is None else end
+		for offset, length, produce in self.segments:
+			if offset + length <= start:
+				continue
+			if offset >= end:
+				break
+			for data in produce(max(0, start - offset), min(length, end - offset)):
+				if data:
+					yield data
+
+
+	def iter_file(self, entry: ZipEntry, start, end):
+		"""
+		Yield bytes `start` to `end` of the entry's file. If its checksum isn't known yet, the file is read from
+		the beginning to work it out.
+		"""
+		pos = start if self.cached_crc(entry) is not None else 0
+		from_beginning = pos == 0
+		crc = 0
+		with open(entry.path, 'rb') as f:
+			f.seek(pos)
+			while pos < end:
+				data = f.read(min(CHUNK_SIZE, end - pos))
+				if not data:
+					raise IOError(f'{entry.path} is shorter than when the export started')
+				if self.throttle is not None:
+					self.throttle(len(data))
+				crc = zlib.crc32(data, crc)
+				if pos + len(data) > start:
+					yield data[max(0, start - pos):]
+				pos += len(data)
+		if from_beginning and pos == entry.size:
+			self.store_crc(entry, crc)
+
+
+	def get_crc(self, entry: ZipEntry):
+		"""Checksum of the entry's file, reading the file if it hasn't been worked out already"""
+		crc = self.cached_crc(entry)
+		if crc is None:
+			for _ in self.iter_file(entry, entry.size, entry.size):
+				pass
+			crc = self.cached_crc(entry)
+		return crc
+
+
+	def cached_crc(self, entry: ZipEntry):
+		key = (entry.path, entry.size, entry.mtime_ns)
+		if key in self.crcs:
+			return self.crcs[key]
+		with self.crc_lock:
+			if key not in self.crc_cache:
+				return None
+			self.crc_cache.move_to_end(key)
+			self.crcs[key] = self.crc_cache[key]
+			return self.crcs[key]
+
+
+	def store_crc(self, entry: ZipEntry, crc):
+		key = (entry.path, entry.size, entry.mtime_ns)
+		self.crcs[key] = crc
+		with self.crc_lock:
+			self.crc_cache[key] = crc
+			self.crc_cache.move_to_end(key)
+			while len(self.crc_cache) > CRC_CACHE_SIZE:
+				self.crc_cache.popitem(last=False)
+
+
+	def central_directory(self):
+		headers = []
+		offset = 0
+		for entry in self.entries:
+			headers.append(entry.central_header(self.get_crc(entry), offset))
+			offset += len(entry.local_header()) + entry.size + len(entry.data_descriptor(0))
+		return b''.join(headers) + self.end_records()
+
+
+	def end_records(self):
+		count = len(self.entries)
+		records = b''
+		if count >= 0xFFFF or self.central_offset >= ZIP64_LIMIT or self.central_size >= ZIP64_LIMIT:
+			zip64_offset = self.central_offset + self.central_size
+			records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+			                       count, count, self.central_size, self.central_offset)
+			records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+		records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+		                       min(self.central_size, ZIP64_LIMIT), min(self.central_offset, ZIP64_LIMIT), 0)
+		return records
+
+
+class Throttle:
+	"""
+	Limits how fast exports read from disk while any recorder is saving a capture, so that the recording isn't held up.
+	Shared by all exports, so the limit is for all of them together. Exports run at full speed otherwise.
+	"""
+
+	def __init__(self, recorders, max_rate):
+		self.recorders = recorders
+		self.max_rate = max_rate   # Bytes per second
+		self.next_time = 0.0
+		self.lock = threading.Lock()
+
+
+	def __call__(self, num_bytes):
+		if not any(recorder.capturing for recorder in self.recorders):
+			return
+		with self.lock:
+			now = time.monotonic()
+			self.next_time = max(self.next_time, now) + num_bytes / self.max_rate
+			delay = self.next_time - now
+		time.sleep(delay)
+
+
+def create_export(recorder, grapher: Grapher, args, throttle=None) -> ZipStream:
+	"""
+	Make a zip of the captures chosen by the request arguments, which can be a `day` (YYYY-MM-DD),
+	a `start` and/or `end` date and time (ISO 8601), or one or more capture `name`s.
+	Each capture's video, data files and graph images are included.
+	"""
+	config = recorder.config
+	names = args.getlist('name')
+	try:
+		day = date.fromisoformat(args['day']) if 'day' in args else None
+		start = parse_local_time(args['start']) if 'start' in args else None
+		end = parse_local_time(args['end']) if 'end' in args else None
+	except ValueError as e:
+		logger.warning(str(e))
+		raise BadRequest(str(e))
+	if not (names or day or start or end):
+		logger.warning('No captures chosen for export')
+		raise BadRequest('Give a day, a start and/or end time, or capture names to export')
+
+	entries = []
+	for path in sorted(config.video_dir.glob('*.mp4')):
+		name = path.stem
+		if config.staging_dir.joinpath(f'{name}.h264').exists():
+			continue   # Still being converted
+		if names and name not in names:
+			continue
+		if day or start or end:
+			info = CaptureInfo.read_from_file(config.data_dir.joinpath(f'{name}.json'))
+			if info:
+				capture_time = datetime.fromtimestamp(info.start_time / 1000000, tz=timezone.utc).astimezone()
+			else:
+				capture_time = datetime.fromtimestamp(path.stat().st_mtime).astimezone()
+			if (day and capture_time.date() != day) or (start and capture_time < start) or (end and capture_time >= end):
+				continue
+
+		files = [path, config.data_dir.joinpath(f'{name}.json'), config.data_dir.joinpath(f'{name}.bin')]
+		if files[2].exists():
+			files += [grapher.get_max_motion_image(name), grapher.get_motion_sum_image(name), grapher.get_sad_sum_image(name)]
+		for file in files:
+			if file.exists():
+				stat = file.stat()
+				entries.append(ZipEntry(file.name, file, stat.st_size, stat.st_mtime_ns))
+
+	if not entries:
+		logger.warning('No captures found to export')
+		raise NotFound('No captures found')
+	return ZipStream(entries, throttle)
+
+
+def export_file_name(recorder, args):
+	if 'day' in args:
+		return f'{recorder.name}-{args["day"]}.zip'
+	return f'{recorder.name}-captures.zip'
+
+
+def parse_local_time(s):
+	t = datetime.fromisoformat(s)
+	return t.astimezone() if t.tzinfo is None else t
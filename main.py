@@ -3,13 +3,16 @@ import subprocess
 import logging
 from pathlib import Path
 import shutil
-from dataclasses import dataclass
+import queue
+from contextlib import ExitStack
+from dataclasses import dataclass, field
 from omegaconf import OmegaConf, MISSING
-from typing import Optional
+from typing import Any, List, Optional
 
-from MotionRecorder import MotionRecorder
+from SimulatedRecorder import SimulatedRecorder
 from data import write_frame_stats
 import webserver
+import asyncserver
 
 
 @dataclass
@@ -38,6 +41,10 @@ class CameraConfig:
 @dataclass
 class AppConfig:
 	camera: CameraConfig
+	name: str = 'camera'            # Name of the recorder, used in web addresses (e.g. /camera/live)
+	camera_num: int = 0             # Which camera to use, on boards with more than one camera connector
+	splitter_port: int = 1          # Camera port to record from (1 to 3). Recorders sharing a camera must each use a different port
+	simulated: bool = False         # Generate test videos and motion data instead of using a camera
 	staging_dir: Path = MISSING     # Where the original recorded H-264 files will go
 	video_dir: Path = MISSING       # Where the re-encoded MP4 files will go
 	data_dir: Path = MISSING        # Where the data files and graph images will go
@@ -50,8 +57,51 @@ class AppConfig:
 	per_block_upper_bound: int = 100   # This is the highest we expect the motion vector per block to be. Used for graph scaling.
 	per_frame_upper_bound: int = 50000 # This is the highest we expect the sum of all vectors per frame to be. Used for graph scaling.
 	scale_boost: int = 20           # How much to boost lower values in log-scaled graphs. 5 = mild, 10 = medium, 50 = strong, 100 = very strong
+	recorders: List[Any] = field(default_factory=list)  # Recorders to run, each overriding any of the above settings. If empty, a single recorder uses the above settings.
 	log_level: str = 'INFO'
 	web_port: int = 8080
+	web_server: str = 'threaded'    # 'threaded' uses Flask's server with a thread per request. 'async' serves streams and files from an event loop
+	web_max_streams: int = 4        # Async server only. Most live stream viewers at once
+	web_max_downloads: int = 4      # Async server only. Most video downloads and exports at once, and separately, graph and frame index downloads
+	web_max_pages: int = 2          # Async server only. Number of threads for everything else (pages, camera controls)
+	export_max_rate: float = 2.0    # MB per second that captures are read from disk for exporting while any recorder is saving a capture
+
+
+def get_recorder_configs(config: OmegaConf) -> list[OmegaConf]:
+	"""Merge each entry in `config.recorders` over the top level settings, to give the full config of each recorder"""
+	if not config.recorders:
+		return [config]
+	recorder_configs = [OmegaConf.merge(config, each) for each in config.recorders]
+	names = [each.name for each in recorder_configs]
+	if len(set(names)) != len(names):
+		raise ValueError(f'Recorder names must be unique, but got {names}')
+
+	# Captures are named by the second they start in, so recorders sharing a directory would overwrite each other's files
+	dir_owners = {}
+	port_owners = {}
+	camera_owners = {}   # The first recorder on each camera opens it, with its own frame rate and sensor mode
+	for each in recorder_configs:
+		for directory in {Path(each.staging_dir).resolve(), Path(each.video_dir).resolve(), Path(each.data_dir).resolve()}:
+			if dir_owners.setdefault(directory, each.name) != each.name:
+				raise ValueError(f'Recorders "{dir_owners[directory]}" and "{each.name}" both use the directory {directory}. Each recorder needs its own directories')
+		if not each.simulated:
+			port = (each.camera_num, each.splitter_port)
+			if port_owners.setdefault(port, each.name) != each.name:
+				raise ValueError(f'Recorders "{port_owners[port]}" and "{each.name}" both use splitter port {each.splitter_port} of camera {each.camera_num}')
+			owner = camera_owners.setdefault(each.camera_num, each)
+			for setting in ('framerate', 'sensor_mode'):
+				if each.camera[setting] != owner.camera[setting]:
+					raise ValueError(f'Recorder "{each.name}" shares camera {each.camera_num} with "{owner.name}", so its camera {setting} '
+					                 f'must be the same ({owner.camera[setting]}), but got {each.camera[setting]}')
+	return recorder_configs
+
+
+def create_recorder(config: OmegaConf, captures: queue.Queue, shared_camera=None):
+	if config.simulated:
+		return SimulatedRecorder(config, captures)
+	# Imported here so that simulated recorders can be run without the camera libraries
+	from MotionRecorder import MotionRecorder
+	return MotionRecorder(config, captures, shared_camera)
 
 
 config_file = Path('config.yaml')
@@ -65,34 +115,49 @@ config = OmegaConf.merge(schema, OmegaConf.load('config.yaml'))
 logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.getLevelName(config.log_level))
 logger = logging.getLogger(__name__)
 
-config.staging_dir.mkdir(exist_ok=True)
-config.video_dir.mkdir(exist_ok=True)
-config.data_dir.mkdir(exist_ok=True)
+recorder_configs = get_recorder_configs(config)
+for recorder_config in recorder_configs:
+	recorder_config.staging_dir.mkdir(parents=True, exist_ok=True)
+	recorder_config.video_dir.mkdir(parents=True, exist_ok=True)
+	recorder_config.data_dir.mkdir(parents=True, exist_ok=True)
 
 try:
-	with MotionRecorder(config) as recorder:
-		recorder.start()
-		web_app = webserver.create(recorder.camera, config)
-		webserver.run(web_app, host='0.0.0.0', port=config.web_port)
+	with ExitStack() as stack:
+		# All recorders post to the one queue, and captures are converted here as they come in.
+		# Recorders on the same camera share the camera opened by the first of them.
+		captures = queue.Queue()
+		cameras = {}
+		recorders = []
+		for recorder_config in recorder_configs:
+			recorder = stack.enter_context(create_recorder(recorder_config, captures, cameras.get(recorder_config.camera_num)))
+			if not recorder_config.simulated:
+				cameras.setdefault(recorder_config.camera_num, recorder.camera)
+			recorder.start()
+			recorders.append(recorder)
+
+		web_app = webserver.create(recorders, config)
+		if config.web_server == 'async':
+			asyncserver.run(web_app, host='0.0.0.0', port=config.web_port, max_streams=config.web_max_streams,
+			                max_downloads=config.web_max_downloads, max_pages=config.web_max_pages)
+		else:
+			webserver.run(web_app, host='0.0.0.0', port=config.web_port)
 		while True:
-			capture = recorder.captures.get()
-			capture_info = capture[0]
-			frame_stats = capture[1]
-			logger.info(f'Motion capture in "{capture_info.name}"')
+			recorder_config, capture_info, frame_stats = captures.get()
+			logger.info(f'Motion capture in "{capture_info.name}" from "{recorder_config.name}"')
 
 			# Convert file
 			try:
-				input_file = config.staging_dir.joinpath(f'{capture_info.name}.h264')
-				output_file = config.video_dir.joinpath(f'{capture_info.name}.mp4')
-				proc = subprocess.Popen(['./convert.sh', str(input_file), str(output_file), str(config.camera.framerate)])
+				input_file = recorder_config.staging_dir.joinpath(f'{capture_info.name}.h264')
+				output_file = recorder_config.video_dir.joinpath(f'{capture_info.name}.mp4')
+				proc = subprocess.Popen(['./convert.sh', str(input_file), str(output_file), str(recorder_config.camera.framerate)])
 				logger.info(f'Starting conversion in sub process {proc.pid}')
 			except Exception as e:
 				logger.error(f'Failed to convert video. {e}')
 
-			capture_info.write_to_file(config.data_dir)
-			write_frame_stats(config.data_dir, capture_info.name, frame_stats)
+			capture_info.write_to_file(recorder_config.data_dir)
+			write_frame_stats(recorder_config.data_dir, capture_info.name, frame_stats)
 
-			recorder.captures.task_done()
+			captures.task_done()
 except (KeyboardInterrupt, SystemExit):
 	logger.info('Shutting down')
 	exit()
@@ -11,7 +11,7 @@ const minInterval = 500; // ms
 
 // Fetch camera settings and populate UI
 function getValues() {
-	fetch('/controls')
+	fetch(window.controlsUrl)
 		.then(r => r.json())
 		.then(values => {
 			for (const k in values) {
@@ -50,7 +50,7 @@ function queueSend(key, value) {
 
 function sendUpdate(data) {
 	console.log('sendUpdate', data);
-	fetch('/controls', {
+	fetch(window.controlsUrl, {
 		method: 'POST',
 		headers: {'Content-Type': 'application/json'},
 		body: JSON.stringify(data)
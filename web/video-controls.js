@@ -8,6 +8,78 @@
 	const bufferBar = document.getElementsByClassName('buffer-range')[0];
 	const playedBar = document.getElementsByClassName('played-bar')[0];
 	const thumb = document.getElementsByClassName('thumb')[0];
+	const graphCursor = document.getElementsByClassName('graph-cursor')[0];
+
+	/* Frame index (see FrameIndexEntry in data.py). Until it has loaded, or if there isn't one,
+	   frames are stepped using the frame rate and the graph cursor follows the play position. */
+	let frameTimes = null;      // Presentation time of each frame, in seconds
+	let frameStatsIndex = null; // Which column of the graphs each frame is
+	let keyframeTimes = [];
+	let statsCount = 0;
+
+
+	function loadFrameIndex(){
+		fetch(window.frameIndexUrl)
+			.then(r => r.ok ? r.arrayBuffer() : null)
+			.then(buffer => {
+				if (!buffer || buffer.byteLength < 12) {
+					return;
+				}
+				const view = new DataView(buffer);
+				if (view.getUint32(0, true) !== 2) {
+					console.log('Unexpected frame index version');
+					return;
+				}
+				const count = Math.min(view.getUint32(4, true), Math.floor((buffer.byteLength - 12) / 25));
+				statsCount = view.getUint32(8, true);
+				frameTimes = new Float64Array(count);
+				frameStatsIndex = new Int32Array(count);
+				for (let i = 0; i < count; i++) {
+					const pos = 12 + i * 25;
+					frameTimes[i] = (view.getUint32(pos, true) + view.getUint32(pos + 4, true) * 4294967296) / 1000000;
+					frameStatsIndex[i] = view.getInt32(pos + 20, true);
+					if (view.getUint8(pos + 24)) {
+						keyframeTimes.push(frameTimes[i]);
+					}
+				}
+				updateGraphCursor();
+			});
+	}
+
+
+	/* Index of the frame showing at the given time, which is the last one starting at or before it */
+	function frameAt(t){
+		let low = 0;
+		let high = frameTimes.length - 1;
+		while (low < high) {
+			const mid = Math.ceil((low + high) / 2);
+			if (frameTimes[mid] <= t) {
+				low = mid;
+			}
+			else {
+				high = mid - 1;
+			}
+		}
+		return low;
+	}
+
+
+	/* Middle of a frame's display time, so that rounding doesn't land on the frame either side of it */
+	function frameMidTime(i){
+		const end = (i + 1 < frameTimes.length) ? frameTimes[i + 1] : video.duration;
+		return (frameTimes[i] + end) / 2;
+	}
+
+
+	function nearestKeyframeTime(t){
+		let nearest = keyframeTimes[0];
+		for (const k of keyframeTimes) {
+			if (Math.abs(k - t) < Math.abs(nearest - t)) {
+				nearest = k;
+			}
+		}
+		return nearest;
+	}
 
 
 	function formatTime(s){
@@ -39,6 +111,27 @@
 		thumb.style.left = playPercent + '%';
 		progressBar.setAttribute('aria-valuenow', Math.round(playPercent));
 		updateBuffered();
+		updateGraphCursor();
+	}
+
+
+	/* Move the line over the graphs to the column for the frame being shown */
+	function updateGraphCursor(t = video.currentTime){
+		let percent;
+		if (frameTimes && frameTimes.length > 0 && statsCount > 0) {
+			const statsIndex = frameStatsIndex[frameAt(t)];
+			if (statsIndex < 0) {
+				return;
+			}
+			percent = ((statsIndex + 0.5) / statsCount) * 100;
+		}
+		else if (isFinite(video.duration) && video.duration > 0) {
+			percent = (t / video.duration) * 100;
+		}
+		else {
+			return;
+		}
+		graphCursor.style.left = percent + '%';
 	}
 
 
@@ -67,7 +160,13 @@
 		}
 		const r = progressBar.getBoundingClientRect();
 		const pos = Math.max(0, Math.min(r.width, ev.clientX - r.left));
-		video.currentTime = Math.max(0, Math.min(video.duration, (pos / r.width) * video.duration));
+		let t = (pos / r.width) * video.duration;
+		if (dragging && keyframeTimes.length > 0) {
+			// While dragging, only go to keyframes. They can be shown without fetching and decoding the
+			// frames before them, which keeps dragging responsive on a slow connection.
+			t = nearestKeyframeTime(t);
+		}
+		video.currentTime = Math.max(0, Math.min(video.duration, t));
 		updatePlayed();
 		updateTimeText();
 	}
@@ -123,7 +222,12 @@
 		if (!isFinite(video.duration) || video.duration === 0) {
 			return;
 		}
-		if (isForward) {
+		let pos;
+		if (frameTimes && frameTimes.length > 0) {
+			const i = frameAt(video.currentTime) + (isForward ? 1 : -1);
+			pos = frameMidTime(Math.max(0, Math.min(frameTimes.length - 1, i)));
+		}
+		else if (isForward) {
 			pos = video.currentTime + (1.0 / window.videoFrameRate);
 		}
 		else {
@@ -181,6 +285,19 @@
 		updateTimeText();
 	});
 
+	video.addEventListener('seeked', function(){
+		updateGraphCursor();
+	});
+
+	// Where supported, follow exactly which frame is being shown rather than only on timeupdate events
+	if ('requestVideoFrameCallback' in video) {
+		const onVideoFrame = function(now, metadata){
+			updateGraphCursor(metadata.mediaTime);
+			video.requestVideoFrameCallback(onVideoFrame);
+		};
+		video.requestVideoFrameCallback(onVideoFrame);
+	}
+
 	video.addEventListener('playing', updatePlayButton);
 	video.addEventListener('pause', updatePlayButton);
 	video.addEventListener('ended', updatePlayButton);
@@ -189,4 +306,5 @@
 	/* Initial UI */
 	updateTimeText();
 	updateBuffered();
+	loadFrameIndex();
 })();
\ No newline at end of file
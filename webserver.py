@@ -6,32 +6,65 @@ from pathlib import Path
 from collections import OrderedDict
 from itertools import groupby
 from omegaconf import OmegaConf
-from picamerax import PiCamera
-from picamerax.exc import PiCameraValueError
 import flask
-from flask import Flask, request, Response, url_for
-from werkzeug.exceptions import BadRequest, NotFound
+from flask import Flask, request, Response, url_for, g
+from werkzeug.exceptions import BadRequest, NotFound, RequestedRangeNotSatisfiable
 
-from data import CaptureInfo
+from data import CaptureInfo, FrameIndexEntry
 from Grapher import Grapher
-from MotionRecorder import get_camera_settings, apply_camera_settings
+from FrameIndexer import FrameIndexer
+from camera_settings import get_camera_settings, apply_camera_settings
+from export import Throttle, create_export, export_file_name
 
 
 logger = logging.getLogger(__name__)
 
-def create(camera, config: OmegaConf):
+def create(recorders, config: OmegaConf):
+	"""
+	Create the web app for the given recorders (MotionRecorder or SimulatedRecorder).
+	Each recorder's pages are under its own name, e.g. /<camera>/live and /<camera>/captures.
+	"""
 	logger.info('Setting up web server')
 
 	log = logging.getLogger('werkzeug')
 	log.setLevel(logging.ERROR)
-	video_dir = config.video_dir
-	frame_rate = config.camera.framerate
-	grapher = Grapher(config)
+	recorders = OrderedDict((recorder.name, recorder) for recorder in recorders)
+	graphers = {name: Grapher(recorder.config) for name, recorder in recorders.items()}
+	frame_indexers = {name: FrameIndexer(recorder.config) for name, recorder in recorders.items()}
+	export_throttle = Throttle(list(recorders.values()), config.export_max_rate * 1000000)
 
 	web_dir = str(Path(__file__).parent / 'web')
 	app = Flask(__name__, static_folder=web_dir, template_folder=web_dir)
+	app.extensions['recorders'] = recorders   # For asyncserver, which serves some routes itself
+	app.extensions['graphers'] = graphers
+	app.extensions['frame_indexers'] = frame_indexers
+	app.extensions['export_throttle'] = export_throttle
 
-	def mjpeg_generator():
+
+	@app.url_value_preprocessor
+	def pull_camera(endpoint, values):
+		"""Look up the recorder named in the URL, so that routes can use `g.recorder`"""
+		if values and 'camera' in values:
+			name = values.pop('camera')
+			if name not in recorders:
+				log_and_abort(NotFound.code, f'There is no camera named {name}')
+			g.camera = name
+			g.recorder = recorders[name]
+
+
+	@app.url_defaults
+	def add_camera(endpoint, values):
+		"""Default to the current camera when building URLs, so templates only need to give it when switching"""
+		if 'camera' in g and app.url_map.is_endpoint_expecting(endpoint, 'camera'):
+			values.setdefault('camera', g.camera)
+
+
+	@app.context_processor
+	def inject_cameras():
+		return dict(cameras=list(recorders), camera=g.get('camera'))
+
+
+	def mjpeg_generator(camera):
 		"""Helper to produce MJPEG frames from the camera."""
 		if camera is None:
 			# No camera yet — yield a 1x1 black jpeg
@@ -63,41 +96,44 @@ def create(camera, config: OmegaConf):
 
 	@app.route('/')
 	def index():
-		return flask.redirect(url_for('live'))
+		return flask.redirect(url_for('live', camera=next(iter(recorders))))
 
 
-	@app.route('/live')
+	@app.route('/<camera>/live')
 	def live():
 		"""Live stream page"""
-		return flask.render_template('live.html', awb_modes=PiCamera.AWB_MODES, exposure_modes=PiCamera.EXPOSURE_MODES)
+		camera = g.recorder.camera
+		return flask.render_template('live.html', awb_modes=camera.AWB_MODES, exposure_modes=camera.EXPOSURE_MODES)
 
 
-	@app.route('/live/stream')
+	@app.route('/<camera>/live/stream')
 	def live_stream():
 		"""Live MJPEG stream"""
-		return Response(mjpeg_generator(), mimetype='multipart/x-mixed-replace; boundary=frame')
+		return Response(mjpeg_generator(g.recorder.camera), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
-	@app.route('/controls', methods=['GET', 'POST'])
+	@app.route('/<camera>/controls', methods=['GET', 'POST'])
 	def camera_controls():
+		camera = g.recorder.camera
 		if request.method == 'POST':
 			try:
 				apply_camera_settings(camera, request.get_json() or {})
-			except (AttributeError, PiCameraValueError) as e:
+			except (AttributeError, ValueError) as e:   # PiCameraValueError is a ValueError
 				log_and_abort(BadRequest.code, str(e))
 			return 'Ok'
 		else:
-			return get_camera_settings(camera, config.camera)
+			return get_camera_settings(camera, g.recorder.config.camera)
 
 
-	@app.route('/captures')
+	@app.route('/<camera>/captures')
 	def captures():
 		"""List files in the video directory"""
+		video_dir = g.recorder.config.video_dir
 		items = []
 		grouped = OrderedDict()
 		if video_dir.exists():
 			for path in sorted(video_dir.glob('*.mp4'), key=lambda x: x.stat().st_mtime, reverse=True):
-				info = CaptureInfo.read_from_file(path.with_suffix('.json'))
+				info = CaptureInfo.read_from_file(g.recorder.config.data_dir.joinpath(f'{path.stem}.json'))
 				items.append({
 					'name': info.name if info else path.stem,
 					'timestamp': parse_time(info.start_time) if info else datetime.now(),
@@ -111,34 +147,70 @@ def create(camera, config: OmegaConf):
 		return flask.render_template('captures.html', grouped=grouped)
 
 
-	@app.route('/captures/download/<name>')
+	@app.route('/<camera>/captures/download/<name>')
 	def download_capture(name):
 		"""Download the selected file"""
-		return flask.send_from_directory(video_dir, name + '.mp4', as_attachment=False)
-
-
-	@app.route('/captures/play/<name>')
+		return flask.send_from_directory(g.recorder.config.video_dir, name + '.mp4', as_attachment=False)
+
+
+	@app.route('/<camera>/captures/export')
+	def export_captures():
+		"""
+		Download a zip of a day's captures (?day=), a time range (?start=&end=) or a selection (?name=&name=).
+		The zip is made as it is sent, and a byte range can be asked for to resume a download.
+		"""
+		export = create_export(g.recorder, graphers[g.camera], request.args, export_throttle)
+		etag = f'"{export.etag}"'
+		headers = {
+			'Accept-Ranges': 'bytes',
+			'ETag': etag,
+			'Content-Disposition': f'attachment; filename="{export_file_name(g.recorder, request.args)}"',
+		}
+		status = 200
+		start, end = 0, export.size
+		if request.range is not None and len(request.range.ranges) == 1 and request.headers.get('If-Range', etag) == etag:
+			part = request.range.range_for_length(export.size)
+			if part is None:
+				raise RequestedRangeNotSatisfiable(length=export.size)
+			start, end = part
+			status = 206
+			headers['Content-Range'] = f'bytes {start}-{end - 1}/{export.size}'
+		headers['Content-Length'] = str(end - start)
+		return Response(export.iter_bytes(start, end), status=status, headers=headers, mimetype='application/zip',
+		                direct_passthrough=True)
+
+
+	@app.route('/<camera>/captures/play/<name>')
 	def play_capture(name):
 		"""Play the selected file"""
-		return flask.render_template('play.html', name=name, frame_rate=frame_rate)
+		# The index version goes in its URL, so browsers don't keep using an index of an older version from their cache
+		return flask.render_template('play.html', name=name, frame_rate=g.recorder.config.camera.framerate,
+		                             frame_index_version=FrameIndexEntry.VERSION)
 
 
-	@app.route('/captures/graphs/<name>/max_motion')
+	@app.route('/<camera>/captures/graphs/<name>/max_motion')
 	def max_motion_graph(name):
-		return send_graph_image(grapher.get_max_motion_image(name))
+		return send_data_file(graphers[g.camera].get_max_motion_image(name))
 
-	@app.route('/captures/graphs/<name>/motion_sum')
+	@app.route('/<camera>/captures/graphs/<name>/motion_sum')
 	def motion_sum_graph(name):
-		return send_graph_image(grapher.get_motion_sum_image(name))
+		return send_data_file(graphers[g.camera].get_motion_sum_image(name))
 
-	@app.route('/captures/graphs/<name>/sad_sum')
+	@app.route('/<camera>/captures/graphs/<name>/sad_sum')
 	def sad_sum_graph(name):
-		return send_graph_image(grapher.get_sad_sum_image(name))
+		return send_data_file(graphers[g.camera].get_sad_sum_image(name))
+
+
+	@app.route('/<camera>/captures/index/<name>')
+	def frame_index(name):
+		"""Frame index of the capture's video (see FrameIndexEntry), for the player"""
+		return send_data_file(frame_indexers[g.camera].get_frame_index(name), mimetype='application/octet-stream')
 
 
-	def send_graph_image(path: Path):
+	def send_data_file(path: Path, mimetype=None):
+		"""Send a graph image or other file made from a capture's data. These don't change, so can be cached."""
 		if path is not None and path.exists():
-			return flask.send_file(path, cache_timeout=timedelta(days=365).total_seconds())
+			return flask.send_file(path, mimetype=mimetype, max_age=int(timedelta(days=365).total_seconds()))
 		else:
 			log_and_abort(NotFound.code, f'The file {path} does not exist')
 